@@ -1,14 +1,35 @@
 import logging
 import asyncio
 import os
-from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, types, F
+import re
+import signal
+import time
+import weakref
+from contextlib import suppress
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Optional
+import httpx
+import orjson
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
-from openai import OpenAI, AuthenticationError, RateLimitError, APIError
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, AuthenticationError, RateLimitError, APIError
+from redis.asyncio import Redis
+
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
 
 # Настройка логирования
 logging.basicConfig(
@@ -32,8 +53,248 @@ GOAL_COEFFICIENTS = {
     'Набрать массу': 0.2
 }
 
-# Инициализация диспетчера
-dp = Dispatcher(storage=MemoryStorage())
+# Формат числового ввода: возраст - целое, вес и рост - с точкой или запятой
+# (допускается и "75." без дробной части).
+# Длина не ограничивается - слишком большие значения отсекает проверка диапазона
+INTEGER_RE = re.compile(r'\d+')
+NUMBER_RE = re.compile(r'\d+(?:[.,]\d*)?')
+
+# Поправка формулы Миффлина-Сан-Жеора по полу
+GENDER_OFFSET = {
+    'Мужской': 5.0,
+    'Женский': -161.0
+}
+
+# Граммы БЖУ на 1 ккал: доля калорий / калорийность 1 г
+PROTEIN_PER_KCAL = 0.30 / 4  # 30% белки, 1г = 4 ккал
+FAT_PER_KCAL = 0.25 / 9  # 25% жиры, 1г = 9 ккал
+CARBS_PER_KCAL = 0.45 / 4  # 45% углеводы, 1г = 4 ккал
+
+# Максимальная длина части меню (лимит сообщения Telegram - 4096 символов)
+MENU_PART_SIZE = 4000
+# При потоковой генерации законченные абзацы отправляются, как только их накопится столько
+MENU_STREAM_PART_SIZE = 500
+
+# Клавиатуры создаются один раз при запуске
+GENDER_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text='Мужской'), KeyboardButton(text='Женский')]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+ACTIVITY_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=activity)] for activity in ACTIVITY_COEFFICIENTS],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+GOAL_KB = ReplyKeyboardMarkup(
+    keyboard=[[KeyboardButton(text=goal)] for goal in GOAL_COEFFICIENTS],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+MENU_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text='📋 Мои данные'), KeyboardButton(text='🔄 Пересчитать')],
+        [KeyboardButton(text='🍽 Сгенерировать меню'), KeyboardButton(text='🆕 Новое меню')]
+    ],
+    resize_keyboard=True
+)
+MENU_BUTTONS = {button.text for row in MENU_KB.keyboard for button in row}
+
+# Заголовок первой части меню и предупреждение об обрезанном ответе
+MENU_HEADER = "📋 Ваше персонализированное меню на неделю:\n\n"
+MENU_TRUNCATED_NOTE = (
+    "⚠️ Меню не поместилось в лимит ответа и было обрезано.\n"
+    "Нажмите «🆕 Новое меню», чтобы получить другой вариант."
+)
+
+# Кэш сгенерированных меню: шаг округления калорий, размер и время жизни (сек)
+MENU_CALORIES_STEP = 100
+MENU_CACHE_SIZE = 2048
+MENU_CACHE_TTL = 24 * 60 * 60
+menu_cache: dict[tuple, tuple[float, str]] = {}
+# Генерации в процессе: одновременные промахи по одному ключу ждут один ответ
+menu_requests: dict[tuple, asyncio.Future] = {}
+
+# Ограничение нагрузки: одновременные запросы к OpenAI и обработка апдейтов
+OPENAI_CONCURRENCY_LIMIT = 8
+UPDATES_CONCURRENCY_LIMIT = 100
+OPENAI_SEM = asyncio.Semaphore(OPENAI_CONCURRENCY_LIMIT)
+# Блокировки чатов живут, пока их кто-то держит или ждет
+chat_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+# Лимит Telegram на отправку: ~30 сообщений в секунду всего
+TELEGRAM_RATE_LIMIT = 30
+TELEGRAM_LIMITER = AsyncLimiter(TELEGRAM_RATE_LIMIT, 1)
+
+# Чаты, для которых Telegram вернул 429: время, до которого отправка в чат отложена
+CHAT_RETRY_SIZE = 10000
+chat_retry_at: dict[int, float] = {}
+
+# Модель OpenAI по умолчанию (переопределяется OPENAI_MODEL, "gpt-4o" - точнее, но дороже)
+DEFAULT_OPENAI_MODEL = 'gpt-4o-mini'
+# С запасом: 7 дней по 5 приемов пищи с БЖУ на русском занимают около 2000 токенов
+MENU_MAX_TOKENS = 3000
+
+# Системный промпт для генерации меню (одинаков для всех запросов)
+SYSTEM_PROMPT = """Ты профессиональный нутрициолог и диетолог, специализирующийся на составлении планов питания для жителей России.
+
+ВАЖНЫЕ ТРЕБОВАНИЯ К МЕНЮ:
+
+1. ТОЛЬКО доступные в России продукты:
+   - Мясо: курица, говядина, свинина, индейка
+   - Рыба: скумбрия, сазан, минтай, горбуша, сom
+   - Крупы: гречка, рис
+   - Гарниры: макароны, картофель (вареный/печеный), гречка, рис
+   - Овощи: капуста, морковь, свекла, огурцы, помидоры, лук
+   - Фрукты: яблоки, бананы, апельсины, груши
+   - Молочное: творог, кефир, молоко, сметана, йогурт натуральный
+   - Яйца куриные
+
+2. ИСКЛЮЧИТЬ экзотические продукты:
+   - НЕ использовать: киноа, семена чиа, авокадо, кускус, булгур, шпинат, руккола, кейл
+   - НЕ использовать дорогие/редкие ингредиенты
+
+3. Простые блюда:
+   - Привычная российская кухня
+   - Простые способы приготовления (варка, запекание, тушение)
+   - Реалистичные рецепты, которые легко готовить дома
+
+4. Примеры блюд:
+   - Завтрак: овсянка, яичница, творог с фруктами, омлет
+   - Обед: куриная грудка с гречкой, рыба с рисом, говядина с макаронами
+   - Ужин: запеченная рыба с овощами, куриные котлеты с картофелем
+   - Перекусы: яблоко, творог, кефир, горсть орехов, банан
+
+5. Учитывай сезонность и доступность продуктов в обычных российских магазинах.
+
+Создавай разнообразное, но ПРОСТОЕ и ДОСТУПНОЕ меню с точным расчетом БЖУ и калорийности."""
+
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# Ключ кэша промптов OpenAI: запросы с общим префиксом (системным промптом)
+# направляются на один сервер. Менять при изменении SYSTEM_PROMPT
+PROMPT_CACHE_KEY = 'nutribot-v1-system'
+
+# Шаблон пользовательского промпта, заполняется параметрами питания
+USER_PROMPT_TEMPLATE = (
+    "Создай подробное сбалансированное меню на неделю для пользователя со следующими параметрами:\n\n"
+    "Пол: {gender}\n"
+    "Уровень активности: {activity}\n"
+    "Цель: {goal}\n\n"
+    "Суточная норма калорий: {daily_calories} ккал\n"
+    "Норма белков: {protein} г/день\n"
+    "Норма жиров: {fat} г/день\n"
+    "Норма углеводов: {carbs} г/день\n\n"
+    "Требования:\n"
+    "1. Создай меню на 7 дней с завтраком, обедом, ужином и 2 перекусами\n"
+    "2. Для каждого блюда укажи примерную калорийность и БЖУ\n"
+    "3. Меню должно быть разнообразным и вкусным\n"
+    "4. Учитывай цель пользователя: {goal}\n"
+    "5. Формат: День X -> приемы пищи с названиями блюд и калорийностью\n"
+    "6. Оформляй меню красиво с использованием нужных эмодзи для каждого приема пищи."
+)
+
+# Время хранения анкеты неактивного пользователя в Redis
+FSM_TTL = timedelta(days=7)
+
+# Таймаут HTTP-запросов к OpenAI (сек), по умолчанию в SDK - 10 минут
+HTTP_TIMEOUT = 60
+
+# Параметры вебхука (адрес сервера задается в WEBHOOK_URL)
+WEBHOOK_PATH = '/tg'
+WEBHOOK_PORT = 8080
+# Сколько одновременных HTTPS-соединений с апдейтами Telegram откроет к серверу
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Роутер с обработчиками анкеты (диспетчер и роутер генерации меню создаются в main)
+router = Router()
+
+
+class OpenAIMiddleware(BaseMiddleware):
+    """Передача клиента OpenAI в обработчики генерации меню"""
+
+    def __init__(self, client: AsyncOpenAI):
+        self.client = client
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Message, dict[str, Any]], Awaitable[Any]],
+        event: types.Message,
+        data: dict[str, Any]
+    ) -> Any:
+        data['openai_client'] = self.client
+        return await handler(event, data)
+
+
+class ConcurrencyMiddleware(BaseMiddleware):
+    """Ограничение числа одновременно обрабатываемых апдейтов в режиме вебхука.
+
+    Ограничивает только обработку: вебхук по-прежнему создает задачу на каждый
+    апдейт, поэтому память не ограничена. Поток входящих апдейтов сдерживает
+    max_connections вебхука, в polling - tasks_concurrency_limit.
+    """
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(
+        self,
+        handler: Callable[[types.Update, dict[str, Any]], Awaitable[Any]],
+        event: types.Update,
+        data: dict[str, Any]
+    ) -> Any:
+        async with self.semaphore:
+            return await handler(event, data)
+
+
+def defer_chat(chat_id: int, retry_after: float):
+    """Отложить отправку в чат на время, указанное Telegram"""
+    now = time.monotonic()
+    if len(chat_retry_at) >= CHAT_RETRY_SIZE:
+        # Удаляем истекшие записи, чтобы словарь не рос бесконечно
+        for key in [key for key, retry_at in chat_retry_at.items() if retry_at <= now]:
+            del chat_retry_at[key]
+    chat_retry_at[chat_id] = max(chat_retry_at.get(chat_id, 0), now + retry_after)
+
+
+class ThrottlingMiddleware(BaseRequestMiddleware):
+    """Ограничение частоты исходящих запросов к Telegram с учетом retry_after.
+
+    Отдельный чат притормаживается только после ответа 429 от Telegram,
+    поэтому частые сообщения одного чата не задерживают остальных.
+    """
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: Any
+    ) -> Any:
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Служебные запросы (getUpdates, setWebhook и т.д.) не ограничиваем
+            return await make_request(bot, method)
+
+        while True:
+            retry_at = chat_retry_at.get(chat_id)
+            if retry_at is not None:
+                delay = retry_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif chat_retry_at.get(chat_id) == retry_at:
+                    del chat_retry_at[chat_id]
+
+            async with TELEGRAM_LIMITER:
+                try:
+                    return await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    logger.warning(f"Превышен лимит Telegram, повтор через {e.retry_after} сек")
+                    defer_chat(chat_id, e.retry_after)
 
 
 # Определение состояний FSM
@@ -49,10 +310,7 @@ class UserStates(StatesGroup):
 
 def calculate_bmr(gender: str, weight: float, height: float, age: int) -> float:
     """Расчет базовой калорийности по формуле Миффлина-Сан-Жеора"""
-    if gender == 'Мужской':
-        return 10 * weight + 6.25 * height - 5 * age + 5
-    else:  # Женский
-        return 10 * weight + 6.25 * height - 5 * age - 161
+    return 10.0 * weight + 6.25 * height - 5.0 * age + GENDER_OFFSET.get(gender, -161.0)
 
 
 def calculate_daily_calories(bmr: float, activity: str, goal: str) -> int:
@@ -60,28 +318,34 @@ def calculate_daily_calories(bmr: float, activity: str, goal: str) -> int:
     activity_coef = ACTIVITY_COEFFICIENTS.get(activity, 1.2)
     goal_coef = GOAL_COEFFICIENTS.get(goal, 0)
 
-    tdee = bmr * activity_coef  # Total Daily Energy Expenditure
-    adjusted_calories = tdee * (1 + goal_coef)
-
-    return round(adjusted_calories)
+    # Total Daily Energy Expenditure с поправкой на цель
+    return round(bmr * activity_coef * (1 + goal_coef))
 
 
 def calculate_macros(calories: int) -> dict:
     """Расчет БЖУ на основе калорийности"""
-    # Стандартное соотношение БЖУ
-    protein_calories = calories * 0.30  # 30% на белки
-    fat_calories = calories * 0.25  # 25% на жиры
-    carb_calories = calories * 0.45  # 45% на углеводы
+    return {
+        'protein': round(calories * PROTEIN_PER_KCAL),
+        'fat': round(calories * FAT_PER_KCAL),
+        'carbs': round(calories * CARBS_PER_KCAL)
+    }
+
+
+def calculate_nutrition(gender: str, weight: float, height: float, age: int,
+                        activity: str, goal: str) -> dict:
+    """Расчет BMR, суточной нормы калорий и БЖУ для сохранения в состоянии"""
+    bmr = calculate_bmr(gender, weight, height, age)
+    daily_calories = calculate_daily_calories(bmr, activity, goal)
 
     return {
-        'protein': round(protein_calories / 4),  # 1г белка = 4 ккал
-        'fat': round(fat_calories / 9),  # 1г жира = 9 ккал
-        'carbs': round(carb_calories / 4)  # 1г углеводов = 4 ккал
+        'bmr': bmr,
+        'daily_calories': daily_calories,
+        'macros': calculate_macros(daily_calories)
     }
 
 
 # Обработчик команды /start
-@dp.message(Command('start'))
+@router.message(Command('start'))
 async def cmd_start(message: types.Message, state: FSMContext):
     """Приветствие и начало опроса"""
     welcome_message = (
@@ -93,20 +357,12 @@ async def cmd_start(message: types.Message, state: FSMContext):
         "Укажите ваш пол:"
     )
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text='Мужской'), KeyboardButton(text='Женский')]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
-    await message.answer(welcome_message, reply_markup=keyboard)
+    await message.answer(welcome_message, reply_markup=GENDER_KB)
     await state.set_state(UserStates.gender)
 
 
 # Обработчик команды /cancel
-@dp.message(Command('cancel'))
+@router.message(Command('cancel'))
 async def cmd_cancel(message: types.Message, state: FSMContext):
     """Отмена текущего действия"""
     await state.clear()
@@ -117,7 +373,7 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
 
 
 # Обработчик выбора пола
-@dp.message(UserStates.gender)
+@router.message(UserStates.gender)
 async def process_gender(message: types.Message, state: FSMContext):
     """Сохранение пола и запрос возраста"""
     user_gender = message.text
@@ -132,156 +388,121 @@ async def process_gender(message: types.Message, state: FSMContext):
 
 
 # Обработчик ввода возраста
-@dp.message(UserStates.age)
+@router.message(UserStates.age)
 async def process_age(message: types.Message, state: FSMContext):
     """Сохранение возраста и запрос веса"""
-    try:
-        user_age = int(message.text)
-        if user_age < 10 or user_age > 120:
-            await message.answer("Пожалуйста, укажите корректный возраст (от 10 до 120 лет):")
-            return
+    text = (message.text or '').strip()
+    if not INTEGER_RE.fullmatch(text):
+        await message.answer("Пожалуйста, введите число:")
+        return
 
-        await state.update_data(age=user_age)
+    user_age = int(text)
+    if user_age < 10 or user_age > 120:
+        await message.answer("Пожалуйста, укажите корректный возраст (от 10 до 120 лет):")
+        return
 
-        await message.answer(
-            f"Ваш возраст: {user_age} лет\n\n"
-            "Укажите ваш вес (в килограммах):"
-        )
-        await state.set_state(UserStates.weight)
-    except ValueError:
-        await message.answer("Пожалуйста, введите число:")
+    await state.update_data(age=user_age)
+
+    await message.answer(
+        f"Ваш возраст: {user_age} лет\n\n"
+        "Укажите ваш вес (в килограммах):"
+    )
+    await state.set_state(UserStates.weight)
 
 
 # Обработчик ввода веса
-@dp.message(UserStates.weight)
+@router.message(UserStates.weight)
 async def process_weight(message: types.Message, state: FSMContext):
     """Сохранение веса и запрос роста"""
-    try:
-        user_weight = float(message.text.replace(',', '.'))
-        if user_weight < 30 or user_weight > 300:
-            await message.answer("Пожалуйста, укажите корректный вес (от 30 до 300 кг):")
-            return
+    text = (message.text or '').strip()
+    if not NUMBER_RE.fullmatch(text):
+        await message.answer("Пожалуйста, введите число:")
+        return
 
-        await state.update_data(weight=user_weight)
+    user_weight = float(text.replace(',', '.'))
+    if user_weight < 30 or user_weight > 300:
+        await message.answer("Пожалуйста, укажите корректный вес (от 30 до 300 кг):")
+        return
 
-        await message.answer(
-            f"Ваш вес: {user_weight} кг\n\n"
-            "Укажите ваш рост (в сантиметрах):"
-        )
-        await state.set_state(UserStates.height)
-    except ValueError:
-        await message.answer("Пожалуйста, введите число:")
+    await state.update_data(weight=user_weight)
+
+    await message.answer(
+        f"Ваш вес: {user_weight} кг\n\n"
+        "Укажите ваш рост (в сантиметрах):"
+    )
+    await state.set_state(UserStates.height)
 
 
 # Обработчик ввода роста
-@dp.message(UserStates.height)
+@router.message(UserStates.height)
 async def process_height(message: types.Message, state: FSMContext):
     """Сохранение роста и запрос уровня активности"""
-    try:
-        user_height = float(message.text.replace(',', '.'))
-        if user_height < 100 or user_height > 250:
-            await message.answer("Пожалуйста, укажите корректный рост (от 100 до 250 см):")
-            return
-
-        await state.update_data(height=user_height)
-
-        keyboard = ReplyKeyboardMarkup(
-            keyboard=[
-                [KeyboardButton(text='Минимальная')],
-                [KeyboardButton(text='Низкая')],
-                [KeyboardButton(text='Средняя')],
-                [KeyboardButton(text='Высокая')],
-                [KeyboardButton(text='Очень высокая')]
-            ],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-
-        await message.answer(
-            f"Ваш рост: {user_height} см\n\n"
-            "Выберите уровень физической активности:\n\n"
-            "• Минимальная - сидячий образ жизни\n"
-            "• Низкая - легкие упражнения 1-3 раза в неделю\n"
-            "• Средняя - умеренные нагрузки 3-5 раз в неделю\n"
-            "• Высокая - интенсивные тренировки 6-7 раз в неделю\n"
-            "• Очень высокая - физическая работа или тренировки 2 раза в день",
-            reply_markup=keyboard
-        )
-        await state.set_state(UserStates.activity)
-    except ValueError:
+    text = (message.text or '').strip()
+    if not NUMBER_RE.fullmatch(text):
         await message.answer("Пожалуйста, введите число:")
+        return
+
+    user_height = float(text.replace(',', '.'))
+    if user_height < 100 or user_height > 250:
+        await message.answer("Пожалуйста, укажите корректный рост (от 100 до 250 см):")
+        return
+
+    await state.update_data(height=user_height)
+
+    await message.answer(
+        f"Ваш рост: {user_height} см\n\n"
+        "Выберите уровень физической активности:\n\n"
+        "• Минимальная - сидячий образ жизни\n"
+        "• Низкая - легкие упражнения 1-3 раза в неделю\n"
+        "• Средняя - умеренные нагрузки 3-5 раз в неделю\n"
+        "• Высокая - интенсивные тренировки 6-7 раз в неделю\n"
+        "• Очень высокая - физическая работа или тренировки 2 раза в день",
+        reply_markup=ACTIVITY_KB
+    )
+    await state.set_state(UserStates.activity)
 
 
 # Обработчик выбора активности
-@dp.message(UserStates.activity)
+@router.message(UserStates.activity, F.text.in_(ACTIVITY_COEFFICIENTS))
 async def process_activity(message: types.Message, state: FSMContext):
     """Сохранение уровня активности и запрос цели"""
     user_activity = message.text
 
-    if user_activity not in ACTIVITY_COEFFICIENTS:
-        await message.answer("Пожалуйста, выберите один из предложенных вариантов:")
-        return
-
     await state.update_data(activity=user_activity)
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text='Похудеть')],
-            [KeyboardButton(text='Поддерживать форму')],
-            [KeyboardButton(text='Набрать массу')]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
     await message.answer(
         f"Уровень активности: {user_activity}\n\n"
         "Какая у вас цель?",
-        reply_markup=keyboard
+        reply_markup=GOAL_KB
     )
     await state.set_state(UserStates.goal)
 
 
 # Обработчик выбора цели
-@dp.message(UserStates.goal)
+@router.message(UserStates.goal, F.text.in_(GOAL_COEFFICIENTS))
 async def process_goal(message: types.Message, state: FSMContext):
     """Сохранение цели и вывод результатов расчета"""
-    user_goal = message.text
-
-    if user_goal not in GOAL_COEFFICIENTS:
-        await message.answer("Пожалуйста, выберите один из предложенных вариантов:")
-        return
-
-    await state.update_data(goal=user_goal)
-
     # Получаем все данные из состояния
     data = await state.get_data()
+    data['goal'] = message.text
 
-    # Расчет калорийности
-    bmr = calculate_bmr(
+    # Расчет калорийности и сохранение анкеты одной записью
+    nutrition = calculate_nutrition(
         data['gender'],
         data['weight'],
         data['height'],
-        data['age']
-    )
-
-    daily_calories = calculate_daily_calories(
-        bmr,
+        data['age'],
         data['activity'],
         data['goal']
     )
+    data.update(nutrition)
 
-    macros = calculate_macros(daily_calories)
-
-    # Сохраняем расчетные данные
-    await state.update_data(
-        bmr=bmr,
-        daily_calories=daily_calories,
-        macros=macros
-    )
+    bmr = nutrition['bmr']
+    daily_calories = nutrition['daily_calories']
+    macros = nutrition['macros']
 
-    result_message = (
-        "✅ Анкета заполнена! Спасибо!\n\n"
+    # Сводка сохраняется в состоянии и выводится в "Мои данные" без пересчета
+    data['summary_text'] = (
         "📊 Ваши данные:\n"
         f"• Пол: {data['gender']}\n"
         f"• Возраст: {data['age']} лет\n"
@@ -294,197 +515,392 @@ async def process_goal(message: types.Message, state: FSMContext):
         f"📈 Норма БЖУ:\n"
         f"• Белки: {macros['protein']} г\n"
         f"• Жиры: {macros['fat']} г\n"
-        f"• Углеводы: {macros['carbs']} г\n\n"
-        "Выберите действие:"
+        f"• Углеводы: {macros['carbs']} г"
     )
+    await state.set_data(data)
 
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text='📋 Мои данные'), KeyboardButton(text='🔄 Пересчитать')],
-            [KeyboardButton(text='🍽 Сгенерировать меню'), KeyboardButton(text='🆕 Новое меню')]
-        ],
-        resize_keyboard=True
+    result_message = (
+        "✅ Анкета заполнена! Спасибо!\n\n"
+        f"{data['summary_text']}\n\n"
+        "Выберите действие:"
     )
 
-    await message.answer(result_message, reply_markup=keyboard)
+    await message.answer(result_message, reply_markup=MENU_KB)
+    await state.set_state(UserStates.menu)
+
+
+# Обработчик ответа не из списка вариантов активности или цели
+@router.message(StateFilter(UserStates.activity, UserStates.goal))
+async def process_unknown_option(message: types.Message):
+    """Повторный запрос выбора из предложенных вариантов"""
+    await message.answer("Пожалуйста, выберите один из предложенных вариантов:")
+
+
+async def refresh_state(state: FSMContext, data: dict):
+    """Повторная запись анкеты: RedisStorage продлевает TTL только при записи"""
     await state.set_state(UserStates.menu)
+    await state.set_data(data)
 
 
 # Обработчик меню "Мои данные"
-@dp.message(UserStates.menu, F.text == '📋 Мои данные')
+@router.message(UserStates.menu, F.text == '📋 Мои данные')
 async def show_my_data(message: types.Message, state: FSMContext):
     """Показать сохраненные данные пользователя"""
     data = await state.get_data()
+    await refresh_state(state, data)
+    await message.answer(data.get(
+        'summary_text',
+        "Данные не найдены. Для заполнения анкеты используйте команду /start"
+    ))
 
-    message_text = (
-        "📊 Ваши данные:\n\n"
-        f"• Пол: {data.get('gender', 'Не указан')}\n"
-        f"• Возраст: {data.get('age', 'Не указан')} лет\n"
-        f"• Вес: {data.get('weight', 'Не указан')} кг\n"
-        f"• Рост: {data.get('height', 'Не указан')} см\n"
-        f"• Активность: {data.get('activity', 'Не указана')}\n"
-        f"• Цель: {data.get('goal', 'Не указана')}\n\n"
-        f"🔥 Базовый обмен: {round(data.get('bmr', 0))} ккал\n"
-        f"🎯 Суточная норма: {data.get('daily_calories', 0)} ккал\n\n"
-        f"📈 Норма БЖУ:\n"
-        f"• Белки: {data.get('macros', {}).get('protein', 0)} г\n"
-        f"• Жиры: {data.get('macros', {}).get('fat', 0)} г\n"
-        f"• Углеводы: {data.get('macros', {}).get('carbs', 0)} г"
-    )
 
-    await message.answer(message_text)
+# Обработчик кнопок меню после истечения срока хранения анкеты
+@router.message(StateFilter(None), F.text.in_(MENU_BUTTONS))
+async def expired_menu(message: types.Message):
+    """Предложить заполнить анкету заново, если данные удалены из хранилища"""
+    await message.answer(
+        "Ваши данные устарели и были удалены.\n"
+        "Для заполнения анкеты используйте команду /start",
+        reply_markup=ReplyKeyboardRemove()
+    )
 
 
 # Обработчик меню "Пересчитать"
-@dp.message(UserStates.menu, F.text == '🔄 Пересчитать')
+@router.message(UserStates.menu, F.text == '🔄 Пересчитать')
 async def recalculate(message: types.Message, state: FSMContext):
     """Начать заполнение анкеты заново"""
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text='Мужской'), KeyboardButton(text='Женский')]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
     await message.answer(
         "Начинаем заново! Укажите ваш пол:",
-        reply_markup=keyboard
+        reply_markup=GENDER_KB
     )
     await state.set_state(UserStates.gender)
 
 
-# Обработчик генерации меню
-@dp.message(UserStates.menu, F.text.in_(['🍽 Сгенерировать меню', '🆕 Новое меню']))
-async def generate_menu(message: types.Message, state: FSMContext, openai_client: OpenAI):
-    """Генерация персонализированного меню через OpenAI"""
-    data = await state.get_data()
+def split_telegram(text: str, limit: int = MENU_PART_SIZE):
+    """Разбиение текста на сообщения не длиннее limit по границам абзацев"""
+    pos = 0
+    while len(text) - pos > limit:
+        # Режем по последнему абзацу, иначе по строке или пробелу
+        end = text.rfind('\n\n', pos, pos + limit)
+        if end <= pos:
+            end = text.rfind('\n', pos, pos + limit)
+        if end <= pos:
+            end = text.rfind(' ', pos, pos + limit)
+        if end <= pos:
+            end = pos + limit
 
-    await message.answer("🤖 Генерирую персонализированное меню... Это может занять несколько секунд.")
+        part = text[pos:end]
+        if part.strip():
+            yield part
+
+        pos = end
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+
+    if text[pos:].strip():
+        yield text[pos:]
+
+
+def get_chat_lock(chat_id: int) -> asyncio.Lock:
+    """Блокировка чата, создается только при первом обращении"""
+    lock = chat_locks.get(chat_id)
+    if lock is None:
+        lock = chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+
+class MenuGenerationError(Exception):
+    """Ответ OpenAI непригоден для отправки и сохранения в кэше"""
 
-    try:
-        # Формирование промпта для ИИ
-        prompt = (
-            f"Создай подробное сбалансированное меню на неделю для пользователя со следующими параметрами:\n\n"
-            f"Пол: {data.get('gender')}\n"
-            f"Возраст: {data.get('age')} лет\n"
-            f"Вес: {data.get('weight')} кг\n"
-            f"Рост: {data.get('height')} см\n"
-            f"Уровень активности: {data.get('activity')}\n"
-            f"Цель: {data.get('goal')}\n\n"
-            f"Суточная норма калорий: {data.get('daily_calories')} ккал\n"
-            f"Норма белков: {data.get('macros', {}).get('protein')} г/день\n"
-            f"Норма жиров: {data.get('macros', {}).get('fat')} г/день\n"
-            f"Норма углеводов: {data.get('macros', {}).get('carbs')} г/день\n\n"
-            f"Требования:\n"
-            f"1. Создай меню на 7 дней с завтраком, обедом, ужином и 2 перекусами\n"
-            f"2. Для каждого блюда укажи примерную калорийность и БЖУ\n"
-            f"3. Меню должно быть разнообразным и вкусным\n"
-            f"4. Учитывай цель пользователя: {data.get('goal')}\n"
-            f"5. Формат: День X -> приемы пищи с названиями блюд и калорийностью"
-            f"6. Оформляй меню красиво с использованием нужных эмодзи для каждого приема пищи."
-        )
 
-        # Запрос к OpenAI API
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",  # или "gpt-3.5-turbo" для более быстрых и дешевых ответов
+def get_cached_menu(key: tuple) -> Optional[str]:
+    """Меню из кэша, если оно еще не устарело"""
+    cached = menu_cache.get(key)
+    if cached is None:
+        return None
+
+    created_at, menu_text = cached
+    if time.monotonic() - created_at > MENU_CACHE_TTL:
+        del menu_cache[key]
+        return None
+    return menu_text
+
+
+def cache_menu(key: tuple, menu_text: str):
+    """Сохранение меню в кэше с вытеснением самой старой записи"""
+    menu_cache.pop(key, None)
+    menu_cache[key] = (time.monotonic(), menu_text)
+    if len(menu_cache) > MENU_CACHE_SIZE:
+        del menu_cache[next(iter(menu_cache))]
+
+
+async def send_menu(message: types.Message, menu_text: str):
+    """Отправка готового меню с заголовком, по частям"""
+    header = MENU_HEADER
+    for part in split_telegram(menu_text):
+        await message.answer(header + part)
+        header = ''
+
+
+async def stream_menu(message: types.Message, openai_client: AsyncOpenAI, prompt: str) -> tuple[str, bool]:
+    """Потоковая генерация меню: части отправляются в чат по мере получения ответа.
+
+    Возвращает текст меню и признак того, что ответ не обрезан по лимиту токенов.
+    """
+    header = MENU_HEADER
+    chunks = []
+    buffer = ''
+
+    async with OPENAI_SEM:
+        # Потоковый запрос к OpenAI API
+        response = await openai_client.chat.completions.create(
+            model=os.getenv('OPENAI_MODEL', DEFAULT_OPENAI_MODEL),
             messages=[
-                {
-                    "role": "system",
-                    "content": """Ты профессиональный нутрициолог и диетолог, специализирующийся на составлении планов питания для жителей России.
-
-                ВАЖНЫЕ ТРЕБОВАНИЯ К МЕНЮ:
-
-                1. ТОЛЬКО доступные в России продукты:
-                   - Мясо: курица, говядина, свинина, индейка
-                   - Рыба: скумбрия, сазан, минтай, горбуша, сom
-                   - Крупы: гречка, рис
-                   - Гарниры: макароны, картофель (вареный/печеный), гречка, рис
-                   - Овощи: капуста, морковь, свекла, огурцы, помидоры, лук
-                   - Фрукты: яблоки, бананы, апельсины, груши
-                   - Молочное: творог, кефир, молоко, сметана, йогурт натуральный
-                   - Яйца куриные
-
-                2. ИСКЛЮЧИТЬ экзотические продукты:
-                   - НЕ использовать: киноа, семена чиа, авокадо, кускус, булгур, шпинат, руккола, кейл
-                   - НЕ использовать дорогие/редкие ингредиенты
-
-                3. Простые блюда:
-                   - Привычная российская кухня
-                   - Простые способы приготовления (варка, запекание, тушение)
-                   - Реалистичные рецепты, которые легко готовить дома
-
-                4. Примеры блюд:
-                   - Завтрак: овсянка, яичница, творог с фруктами, омлет
-                   - Обед: куриная грудка с гречкой, рыба с рисом, говядина с макаронами
-                   - Ужин: запеченная рыба с овощами, куриные котлеты с картофелем
-                   - Перекусы: яблоко, творог, кефир, горсть орехов, банан
-
-                5. Учитывай сезонность и доступность продуктов в обычных российских магазинах.
-
-                Создавай разнообразное, но ПРОСТОЕ и ДОСТУПНОЕ меню с точным расчетом БЖУ и калорийности."""
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
+                SYSTEM_MESSAGE,
+                {"role": "user", "content": prompt}
             ],
             temperature=0.7,
-            max_tokens=3000
+            max_tokens=MENU_MAX_TOKENS,
+            prompt_cache_key=PROMPT_CACHE_KEY,
+            stream=True
         )
 
-        # Получение ответа от ИИ
-        menu_text = response.choices[0].message.content
+        finish_reason = None
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            if chunk.choices[0].finish_reason:
+                finish_reason = chunk.choices[0].finish_reason
+            if not chunk.choices[0].delta.content:
+                continue
+            chunks.append(chunk.choices[0].delta.content)
+            buffer += chunk.choices[0].delta.content
+
+            # Отправляем законченные абзацы (дни, приемы пищи), незаконченный копится дальше
+            if len(buffer) < MENU_STREAM_PART_SIZE:
+                continue
+            boundary = buffer.rfind('\n\n')
+            if boundary > 0:
+                ready, buffer = buffer[:boundary], buffer[boundary + 2:]
+            elif len(buffer) > MENU_PART_SIZE:
+                ready, buffer = buffer, ''
+            else:
+                continue
+
+            for part in split_telegram(ready):
+                await message.answer(header + part)
+                header = ''
+
+    menu_text = ''.join(chunks)
+    if not menu_text.strip():
+        raise MenuGenerationError("ИИ вернул пустое меню.")
+
+    for part in split_telegram(buffer):
+        await message.answer(header + part)
+        header = ''
+
+    # Обрезанное по лимиту токенов меню показываем с предупреждением
+    complete = finish_reason != 'length'
+    if not complete:
+        await message.answer(MENU_TRUNCATED_NOTE)
+    return menu_text, complete
+
+
+# Обработчик генерации меню (регистрируется в create_menu_router)
+async def generate_menu(message: types.Message, state: FSMContext, openai_client: AsyncOpenAI):
+    """Генерация персонализированного меню через OpenAI"""
+    data = await state.get_data()
+    await refresh_state(state, data)
 
-        # Отправка меню пользователю (разбиваем на части, если слишком длинное)
-        if len(menu_text) > 4096:  # Ограничение Telegram на длину сообщения
-            # Разбиваем текст на части по 4000 символов
-            parts = [menu_text[i:i + 4000] for i in range(0, len(menu_text), 4000)]
-            for i, part in enumerate(parts, 1):
-                await message.answer(f"📋 Ваше меню (часть {i}/{len(parts)}):\n\n{part}")
-        else:
-            await message.answer(f"📋 Ваше персонализированное меню на неделю:\n\n{menu_text}")
+    # Один чат - один запрос за раз: повторные нажатия не ставятся в очередь
+    chat_lock = get_chat_lock(message.chat.id)
+    if chat_lock.locked():
+        await message.answer("⏳ Меню уже генерируется, пожалуйста, подождите.")
+        return
 
-    except AuthenticationError:
-        await message.answer(
-            "❌ Ошибка аутентификации OpenAI API.\n"
-            "Проверьте правильность токена OPENAI_API_KEY в коде."
-        )
-    except RateLimitError:
-        await message.answer(
-            "⚠️ Превышен лимит запросов к OpenAI API.\n"
-            "Пожалуйста, попробуйте позже."
-        )
-    except APIError as e:
-        await message.answer(
-            f"❌ Ошибка API OpenAI: {str(e)}\n"
-            "Пожалуйста, попробуйте позже."
-        )
-    except Exception as e:
-        logger.error(f"Ошибка при генерации меню: {e}")
-        await message.answer(
-            "❌ Произошла ошибка при генерации меню.\n"
-            "Пожалуйста, попробуйте еще раз."
-        )
+    async with chat_lock:
+        await message.answer("🤖 Генерирую персонализированное меню... Это может занять несколько секунд.")
+
+        try:
+            # Ключ кэша - только параметры питания, калорийность округляется до сотен
+            calories = round(data['daily_calories'] / MENU_CALORIES_STEP) * MENU_CALORIES_STEP
+            cache_key = (data['gender'], data['activity'], data['goal'], calories)
+
+            # "Новое меню" - всегда свежий вариант вместо сохраненного
+            menu_text = None
+            if message.text != '🆕 Новое меню':
+                menu_text = get_cached_menu(cache_key)
+                pending = menu_requests.get(cache_key)
+                if menu_text is None and pending is not None:
+                    # Такое же меню уже генерируется для другого чата - ждем его
+                    menu_text = await asyncio.shield(pending)
+
+            if menu_text is not None:
+                await send_menu(message, menu_text)
+            else:
+                macros = calculate_macros(calories)
+                prompt = USER_PROMPT_TEMPLATE.format(
+                    gender=data['gender'],
+                    activity=data['activity'],
+                    goal=data['goal'],
+                    daily_calories=calories,
+                    protein=macros['protein'],
+                    fat=macros['fat'],
+                    carbs=macros['carbs']
+                )
+
+                request = None
+                if cache_key not in menu_requests:
+                    request = menu_requests[cache_key] = asyncio.get_running_loop().create_future()
+                result = None
+                try:
+                    menu_text, complete = await stream_menu(message, openai_client, prompt)
+                    if complete:
+                        cache_menu(cache_key, menu_text)
+                        result = menu_text
+                finally:
+                    # Ожидающие получают готовое меню или None и генерируют сами
+                    if request is not None:
+                        del menu_requests[cache_key]
+                        request.set_result(result)
+
+        except AuthenticationError:
+            await message.answer(
+                "❌ Ошибка аутентификации OpenAI API.\n"
+                "Проверьте правильность токена OPENAI_API_KEY в коде."
+            )
+        except RateLimitError:
+            await message.answer(
+                "⚠️ Превышен лимит запросов к OpenAI API.\n"
+                "Пожалуйста, попробуйте позже."
+            )
+        except APIError as e:
+            await message.answer(
+                f"❌ Ошибка API OpenAI: {str(e)}\n"
+                "Пожалуйста, попробуйте позже."
+            )
+        except MenuGenerationError as e:
+            logger.warning(f"Меню не сгенерировано: {e}")
+            await message.answer(
+                f"❌ {e}\n"
+                "Пожалуйста, попробуйте еще раз."
+            )
+        except Exception as e:
+            logger.error(f"Ошибка при генерации меню: {e}")
+            await message.answer(
+                "❌ Произошла ошибка при генерации меню.\n"
+                "Пожалуйста, попробуйте еще раз."
+            )
+
+
+def create_menu_router(openai_client: AsyncOpenAI) -> Router:
+    """Роутер генерации меню: клиент OpenAI передается только в его обработчик"""
+    menu_router = Router()
+    menu_router.message.register(
+        generate_menu,
+        UserStates.menu,
+        F.text.in_(['🍽 Сгенерировать меню', '🆕 Новое меню'])
+    )
+    menu_router.message.middleware(OpenAIMiddleware(openai_client))
+    return menu_router
+
+
+def create_storage() -> BaseStorage:
+    """Хранилище FSM: Redis, если задан REDIS_URL, иначе память процесса"""
+    redis_url = os.getenv('REDIS_URL')
+    if not redis_url:
+        logger.warning("REDIS_URL не задан, данные пользователей хранятся в памяти")
+        return MemoryStorage()
+
+    # orjson пишет кириллицу как UTF-8 без \uXXXX-экранирования - данные компактнее
+    return RedisStorage(
+        redis=Redis.from_url(redis_url),
+        state_ttl=FSM_TTL,
+        data_ttl=FSM_TTL,
+        json_loads=orjson.loads,
+        json_dumps=orjson.dumps
+    )
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, webhook_url: str):
+    """Прием обновлений от Telegram через вебхук на aiohttp-сервере"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=os.getenv('WEBHOOK_SECRET')
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    dp.update.outer_middleware(ConcurrencyMiddleware(UPDATES_CONCURRENCY_LIMIT))
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, port=int(os.getenv('WEBHOOK_PORT', WEBHOOK_PORT)))
+    await site.start()
+
+    # Вебхук регистрируется, когда сервер уже принимает запросы
+    await bot.set_webhook(
+        webhook_url.rstrip('/') + WEBHOOK_PATH,
+        secret_token=os.getenv('WEBHOOK_SECRET'),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True
+    )
+
+    # Сервер работает до SIGTERM/SIGINT (остановка контейнера или Ctrl+C)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        with suppress(NotImplementedError):  # Windows не поддерживает обработчики сигналов
+            loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки, завершаем работу...")
+    finally:
+        await runner.cleanup()
 
 
 async def main():
     """Главная функция запуска бота"""
-    load_dotenv()
-
-    # Создание клиента OpenAI
-    openai_client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    # В production переменные окружения задает оркестратор, .env не нужен
+    if os.getenv('NUTRIBOT_ENV') != 'prod':
+        from dotenv import load_dotenv
+        load_dotenv()
+
+    # Клиент OpenAI: в отличие от стандартного - HTTP/2 и таймаут 60 сек вместо 600
+    openai_client = AsyncOpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        http_client=DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            timeout=HTTP_TIMEOUT
+        )
+    )
 
-    # Инициализация бота
+    # Инициализация бота (сессия aiohttp по умолчанию уже переиспользует соединения)
     bot = Bot(token=os.getenv('TOKEN'))
+    bot.session.middleware(ThrottlingMiddleware())
 
-    # Сохраняем клиент OpenAI в workflow_data для доступа из обработчиков
-    dp.workflow_data.update(openai_client=openai_client)
+    # Инициализация диспетчера
+    dp = Dispatcher(storage=create_storage())
+    dp.include_routers(router, create_menu_router(openai_client))
 
-    # Запуск бота
+    # Запуск бота: вебхук, если задан WEBHOOK_URL, иначе long polling
+    webhook_url = os.getenv('WEBHOOK_URL')
     logger.info("Бот запущен...")
-    await dp.start_polling(bot)
+    try:
+        if webhook_url:
+            await run_webhook(dp, bot, webhook_url)
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATES_CONCURRENCY_LIMIT)
+    finally:
+        await dp.storage.close()
+        await openai_client.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file